@@ -7,17 +7,32 @@ Author: INOE LB
 """
 
 
+import csv
+import functools
 import pdfplumber
 import pandas as pd
+import numpy as np
 import os
 import re
+from collections import defaultdict
 from datetime import datetime
-import glob
-from io import StringIO  # Fixed import for in-memory CSV reading
+from io import StringIO
+from pathlib import Path
 
 # === AUTODETECT FILES ===
-pdf_matches = glob.glob("*.pdf")
-csv_matches = glob.glob("LidarConfiguration*.csv")
+# One directory scan classifies both file kinds instead of two glob passes
+pdf_matches, csv_matches = [], []
+with os.scandir(".") as it:
+    for entry in it:
+        if not entry.is_file():
+            continue
+        name = entry.name
+        if name.startswith("."):  # glob never matched hidden files
+            continue
+        if name.endswith(".pdf"):
+            pdf_matches.append(name)
+        elif name.startswith("LidarConfiguration") and name.endswith(".csv"):
+            csv_matches.append(name)
 
 if not pdf_matches:
     raise FileNotFoundError("No PDF file found in current directory.")
@@ -38,27 +53,31 @@ def normalize_wavelength(w):
     except:
         return None
 
+# wavelength(4 digits) + range + scattering + mode + optional suffix
+_ATLAS_RE = re.compile(r"^(\d{4})(.)(.)(.)(.?)$")
+_DEPOL_RE = re.compile(r"Depolarization calibration\s+(\d{2}-\d{2}-\d{4})")
+
+@functools.lru_cache(maxsize=None)
 def parse_atlas_id(atlas_id):
-    parts = {
-        "wavelength": atlas_id[:4],
-        "range": atlas_id[4],
-        "scattering": atlas_id[5],
-        "mode": atlas_id[6],
-        "suffix": atlas_id[7] if len(atlas_id) > 7 else ""
-    }
-    return parts
+    m = _ATLAS_RE.match(atlas_id)
+    if m is None:
+        return None
+    return (int(m[1]), m[2], m[3], m[4], m[5])
 
 # === PARSE PDF ===
 with pdfplumber.open(PDF_FILE) as pdf:
     depol_date = None
+    # Only page 0 carries the depol date, so skip extract_text (the expensive
+    # layout analysis) on every other page
+    match = _DEPOL_RE.search(pdf.pages[0].extract_text())
+    if match:
+        depol_date = datetime.strptime(match.group(1), "%d-%m-%Y").strftime("%d/%m/%Y 00:00")
+
     all_tables = []
-    for i, page in enumerate(pdf.pages):
-        text = page.extract_text()
-        if i == 0:
-            match = re.search(r"Depolarization calibration\s+(\d{2}-\d{2}-\d{4})", text)
-            if match:
-                depol_date = datetime.strptime(match.group(1), "%d-%m-%Y").strftime("%d/%m/%Y 00:00")
+    for page in pdf.pages:
         all_tables.extend(page.extract_tables())
+        if len(all_tables) >= 5:  # only tables 3 and 4 are used below
+            break
 
 channel_raw = all_tables[3]
 channel_df = pd.DataFrame(channel_raw[3:], columns=channel_raw[2])
@@ -76,89 +95,123 @@ background_df.columns = [
 ]
 
 # Merge PDF data
-channel_data = {}
-for _, row in channel_df.iterrows():
-    aid = row["ATLAS ID"]
-    if pd.notna(aid) and str(aid).strip() != "ATLAS ID":
-        channel_data[aid] = row.to_dict()
-for _, row in background_df.iterrows():
-    aid = row["ATLAS ID"]
+# Filter repeated header rows once with a vectorized mask, then convert the
+# whole table to a dict in one call rather than row by row
+channel_df = channel_df[channel_df["ATLAS ID"].notna() & channel_df["ATLAS ID"].str.strip().ne("ATLAS ID")]
+channel_data = dict(zip(channel_df["ATLAS ID"], channel_df.to_dict(orient="records")))
+background_df = background_df[background_df["ATLAS ID"].notna() & background_df["ATLAS ID"].str.strip().ne("ATLAS ID")]
+# zip over records instead of to_dict(orient="index"), which raises on
+# duplicated ATLAS IDs; later rows win, as in the original row loop
+for aid, data in zip(background_df["ATLAS ID"], background_df.to_dict(orient="records")):
     if aid in channel_data:
-        channel_data[aid].update(row.to_dict())
+        channel_data[aid].update(data)
 
 # === READ CSV FILE ===
 with open(CSV_FILE, "r", encoding="utf-8") as f:
     lines = f.readlines()
 
-section_indices = {line.strip(): i for i, line in enumerate(lines) if line.strip() in ["HoiChannels", "PolarizationCrosstalkParameter"]}
-hoi_start = section_indices.get("HoiChannels")
-polar_start = section_indices.get("PolarizationCrosstalkParameter")
+# The sections appear in a known order, so one scan with an early break
+# finds both without touching the rest of the file
+hoi_start = polar_start = None
+for i, line in enumerate(lines):
+    stripped = line.strip()
+    if stripped == "HoiChannels":
+        hoi_start = i
+    elif stripped == "PolarizationCrosstalkParameter":
+        polar_start = i
+        break
 
 if hoi_start is None:
     raise ValueError("HoiChannels section not found in CSV.")
 if polar_start is None:
     raise ValueError("PolarizationCrosstalkParameter section not found in CSV.")
 
+# Let pandas' C tokenizer parse the HoI section instead of splitting each
+# line in Python; dtype=str + keep_default_na keeps fields as-is
 hoi_columns = [h.strip() for h in lines[hoi_start + 1].strip().split(",")]
-hoi_data_lines = lines[hoi_start + 2:polar_start - 1]
-original_hoi_df = pd.DataFrame([dict(zip(hoi_columns, line.strip().split(","))) for line in hoi_data_lines if line.strip()])
+hoi_nrows = sum(1 for line in lines[hoi_start + 2:polar_start - 1] if line.strip())
+original_hoi_df = pd.read_csv(
+    CSV_FILE,
+    skiprows=hoi_start + 2,
+    nrows=hoi_nrows,
+    header=None,
+    names=hoi_columns,
+    dtype=str,
+    keep_default_na=False,
+)
+# Few distinct detection modes, so store the column as category; the value
+# columns stay str because they round-trip verbatim into the output CSV
+original_hoi_df["_detection_mode_id_id"] = original_hoi_df["_detection_mode_id_id"].astype("category")
 
 polar_columns = [h.strip() for h in lines[polar_start + 1].strip().split(",")]
-polar_data_lines = lines[polar_start + 2:]
-polar_df = pd.DataFrame([dict(zip(polar_columns, line.strip().split(","))) for line in polar_data_lines if line.strip()])
 
 # === REVERSED MATCHING: PDF is reference, CSV is matched ===
 atlas_to_csv_id = {}
 used_csv_ids = set()
 log_lines = []
 
+# Single-pass hash index on (detection mode, normalized wavelength) -> CSV ids
+# in original order, so each ATLAS ID resolves in O(1) instead of a full rescan
+hoi_index = defaultdict(list)
+for cid, mode, wl in zip(original_hoi_df["id"], original_hoi_df["_detection_mode_id_id"], original_hoi_df["if_center"]):
+    hoi_index[(mode, normalize_wavelength(wl))].append(cid)
+
 matched_data = {}
 for aid, match in channel_data.items():
-    atlas_parts = parse_atlas_id(aid)
-    try:
-        match_wl = int(atlas_parts["wavelength"])
-    except ValueError:
+    atlas_parts = parse_atlas_id(str(aid))
+    if atlas_parts is None:
         log_lines.append(f"Skipped invalid ATLAS ID (bad wavelength): {aid}")
         continue
-    match_mode = "an" if atlas_parts["mode"] == "a" else "pc"
-
-    possible_matches = original_hoi_df[
-        (original_hoi_df["_detection_mode_id_id"] == match_mode) &
-        (original_hoi_df["if_center"].apply(lambda x: normalize_wavelength(x) == match_wl)) &
-        (~original_hoi_df["id"].isin(used_csv_ids))
-    ]
-
-    if len(possible_matches) > 0:
-        row = possible_matches.iloc[0].copy()
-        log_lines.append(f"Matched automatically: {aid} → CSV ID: {row['id']}")
-        used_csv_ids.add(row["id"])
-        atlas_to_csv_id[aid] = row["id"]
-        matched_data[row["id"]] = match
+    match_wl, _, _, atlas_mode, _ = atlas_parts
+    match_mode = "an" if atlas_mode == "a" else "pc"
+
+    bucket = hoi_index.get((match_mode, match_wl), [])
+    while bucket and bucket[0] in used_csv_ids:
+        bucket.pop(0)
+    cid = bucket.pop(0) if bucket else None
+
+    if cid is not None:
+        log_lines.append(f"Matched automatically: {aid} → CSV ID: {cid}")
+        used_csv_ids.add(cid)
+        atlas_to_csv_id[aid] = cid
+        matched_data[cid] = match
     else:
         log_lines.append(f"Not matched: {aid}")
 
-# Update HoiChannels while keeping order
-updated_rows = []
-for _, row in original_hoi_df.iterrows():
-    row = row.copy()
-    cid = row["id"]
-    if cid in matched_data:
-        match = matched_data[cid]
-        row["if_center"] = match.get("Interference filter center", row.get("if_center", ""))
-        row["if_fwhm"] = match.get("Interference filter FWHM", row.get("if_fwhm", ""))
-        row["emission_wavelength"] = match.get("Emission Wavelength", row.get("emission_wavelength", ""))
-        row["dead_time"] = match.get("Dead time", row.get("dead_time", ""))
-        row["first_signal_rangebin"] = match.get("First signal rangebin", row.get("first_signal_rangebin", ""))
-        row["trigger_delay"] = match.get("Trigger delay", row.get("trigger_delay", ""))
-        row["_background_mode_id_id"] = 0 if match.get("Background Mode") == "Pre-Trigger" else 1
-        row["_Minimum_channel_height_"] = match.get("Minimum channel height", "")
-        row["_Maximum_channel_height_"] = match.get("Maximum channel height", "")
-    updated_rows.append(row)
+# Update HoiChannels while keeping order — vectorized column assignments
+# from the matched PDF data instead of rebuilding every row with iterrows
+if matched_data:
+    pdf_df = pd.DataFrame.from_dict(matched_data, orient="index")
+    if "Background Mode" not in pdf_df.columns:
+        # No matched channel had a background-table row; default to mode 1
+        # below, as match.get("Background Mode") did
+        pdf_df["Background Mode"] = np.nan
+    merged = original_hoi_df.merge(pdf_df, left_on="id", right_index=True, how="left")
+    matched_mask = original_hoi_df["id"].isin(matched_data).to_numpy()
+    pdf_to_csv_columns = {
+        "Interference filter center": "if_center",
+        "Interference filter FWHM": "if_fwhm",
+        "Emission Wavelength": "emission_wavelength",
+        "Dead time": "dead_time",
+        "First signal rangebin": "first_signal_rangebin",
+        "Trigger delay": "trigger_delay",
+        "Minimum channel height": "_Minimum_channel_height_",
+        "Maximum channel height": "_Maximum_channel_height_",
+    }
+    for pdf_col, csv_col in pdf_to_csv_columns.items():
+        original_hoi_df.loc[matched_mask, csv_col] = merged.loc[matched_mask, pdf_col]
+    original_hoi_df.loc[matched_mask, "_background_mode_id_id"] = np.where(
+        merged.loc[matched_mask, "Background Mode"].fillna("").eq("Pre-Trigger"), np.int8(0), np.int8(1)
+    )
 
 if "_Minimum_channel_height_" not in hoi_columns:
     hoi_columns += ["_Minimum_channel_height_", "_Maximum_channel_height_"]
 
-updated_hoi_df = pd.DataFrame(updated_rows).reindex(columns=hoi_columns)
+# Only the appended height columns can hold NaN (unmatched rows); fill just
+# those so fillna never touches the categorical detection-mode column
+updated_hoi_df = original_hoi_df.reindex(columns=hoi_columns)
+height_cols = ["_Minimum_channel_height_", "_Maximum_channel_height_"]
+updated_hoi_df[height_cols] = updated_hoi_df[height_cols].fillna("")
 
 # === POLARIZATION SECTION ===
 polar_updates = []
@@ -171,49 +224,29 @@ for aid, match in channel_data.items():
         entry["measurement_date"] = depol_date
         polar_updates.append(entry)
 
-polar_df_clean = pd.DataFrame(polar_updates, columns=polar_columns)
-polar_df_clean = polar_df_clean[polar_df_clean["g"].notna() & polar_df_clean["h"].notna()]
+# Drop empty polar rows in-memory instead of re-reading the output afterwards
+polar_rows = [e for e in polar_updates if str(e.get("g", "")).strip() and str(e.get("h", "")).strip()]
 
 # === SAVE OUTPUT ===
-with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-    f.writelines(lines[:hoi_start + 1])
-    f.write(",".join(hoi_columns) + "\n")
-    updated_hoi_df.to_csv(f, index=False, header=False, lineterminator="\n")
-    f.write("\n")
-    f.write("PolarizationCrosstalkParameter\n")
-    f.write(",".join(polar_columns) + "\n")
-    polar_df_clean.to_csv(f, index=False, header=False, lineterminator="\n")
-    f.write("\n")
-    f.write("Products\n")
-    f.writelines(lines[lines.index("Products\n") + 1:])
-
-# === CLEANUP EMPTY POLAR ROWS ===
-with open(OUTPUT_FILE, "r", encoding="utf-8") as f:
-    all_lines = f.readlines()
-
-try:
-    polar_start = all_lines.index("PolarizationCrosstalkParameter\n")
-    products_index = all_lines.index("Products\n")
-    polar_header = all_lines[polar_start + 1]
-    polar_data = all_lines[polar_start + 2:products_index]
-    polar_df = pd.read_csv(StringIO(polar_header + "".join(polar_data)))
-    polar_df = polar_df[polar_df["g"].notna() & polar_df["g"].astype(str).str.strip().ne("")]
-
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        f.writelines(all_lines[:polar_start + 1])
-        f.write(polar_header)
-        polar_df.fillna("").astype(str).to_csv(f, index=False, header=False, lineterminator="\n")
-        f.write("\n")
-        f.writelines(all_lines[products_index:])
-except Exception as e:
-    print("Post-cleanup error:", e)
+# Assemble the whole file in memory and touch the disk exactly once
+buf = StringIO()
+buf.writelines(lines[:hoi_start + 1])
+writer = csv.writer(buf, lineterminator="\n")
+writer.writerow(hoi_columns)
+writer.writerows(updated_hoi_df.itertuples(index=False, name=None))
+buf.write("\n")
+buf.write("PolarizationCrosstalkParameter\n")
+polar_writer = csv.DictWriter(buf, fieldnames=polar_columns, lineterminator="\n")
+polar_writer.writeheader()
+polar_writer.writerows(polar_rows)
+buf.write("\n")
+buf.write("Products\n")
+buf.writelines(lines[lines.index("Products\n") + 1:])
+Path(OUTPUT_FILE).write_text(buf.getvalue(), encoding="utf-8")
 
 # === LOG FILE ===
 with open(LOG_FILE, "w", encoding="utf-8") as logf:
-    logf.write("Channel Matching Log\n")
-    logf.write("====================\n\n")
-    for line in log_lines:
-        logf.write(line + "\n")
+    logf.write("Channel Matching Log\n====================\n\n" + "\n".join(log_lines) + "\n")
 
 print(f"\nDONE: Saved updated file as '{OUTPUT_FILE}'")
 print(f"Matching log saved as '{LOG_FILE}'")